@@ -1,9 +1,20 @@
 import argparse
+import codecs
 import os
 import json
-from datetime import datetime
+import shutil
+import sys
+from collections.abc import Iterator
+from datetime import date, datetime
+from functools import lru_cache
+from itertools import chain
 from pathlib import Path
 
+try:
+    import orjson  # optional, much faster than json for big files
+except ImportError:
+    orjson = None
+
 '''
 LICENCE-MIT
 
@@ -41,8 +52,15 @@ Project hosted at https://github.com/Miyan0/qif2json
 
 DEFAULT_JSON_PATH = Path('/data.json')
 
+# size of the blocks read when streaming a qif file
+READ_BLOCK_SIZE = 64 * 1024
+# size of the file buffer, less read calls than the default 8 KiB
+READ_BUFFER_SIZE = 1024 * 1024
+
 # supported encoding
 ENCODING_UTF8 = 'utf-8'
+ENCODING_UTF8_SIG = 'utf-8-sig'  # utf-8 with a BOM, which is skipped
+ENCODING_UTF16 = 'utf-16'  # its BOM gives the byte order and is skipped
 ENCODING_CP1252 = 'cp1252'
 
 # supported qif extension
@@ -58,10 +76,105 @@ CLEAR_AUTO_SWITCH = '!Clear:AutoSwitch'
 CATEGORY_TAG_MAC = '!TYPE:Cat'
 CATEGORY_TAG_WIN = '!Type:Cat'
 
+# line prefixes mapped to the key they're stored in
+ACCOUNT_FIELDS = {
+    'N': 'name',
+    'B': 'balance',
+    'D': 'description',
+    'T': 'type',
+    'L': 'credit_limit',
+    'A': 'address',
+}
+
+TRANSACTION_FIELDS = {
+    'M': 'memo',
+    'T': 'amount',
+    'U': 'amount2',
+    'N': 'ref_number',
+    'F': 'reimbursable',
+    'Y': 'security_name',
+    'I': 'security_price',
+    'Q': 'share_qty',
+    'O': 'commission_cost',
+}
+
+# transaction fields with few distinct values, they're interned so every
+# transaction with the same payee (etc.) shares one str
+INTERNED_TRANSACTION_FIELDS = {
+    'P': 'payee',
+    'C': 'reconciled',
+    'L': 'category',
+}
+
+# account infos at the top of an account's transactions
+TRANSACTION_ACCOUNT_FIELDS = {
+    'N': 'name',
+    'T': 'type',
+    'D': 'description',
+
+    # mac qmtf file specifics
+    'B': 'balance',
+    'L': 'credit_limit',
+    'A': 'memo',
+}
+
+# category prefixes without special handling (see parse_category)
+CATEGORY_FIELDS = {
+    'N': 'name',
+    'D': 'description',
+    'R': 'tax',
+}
+
+SPLIT_FIELDS = {
+    'S': 'category',
+    'E': 'memo',
+}
+SPLIT_PREFIXES = ('S', 'E', '$')
+
+# keys always present in parsed categories and accounts, copying these
+# is cheaper than building the same dict literal for every entry
+CATEGORY_TEMPLATE = {
+    "name": None,
+    "description": None,
+    "type": None,   # 'I' for income, 'E' for expense
+    "tax": None,    # a number if category is tax related,
+}
+
+ACCOUNT_TEMPLATE = {
+    "name": None,
+    "description": None,
+    "type": None,
+}
+
+# translation table for windows dates (see convert_date_windows)
+WIN_DATE_SEPARATORS = str.maketrans("/'", "  ")
+
 # platforms
 MACOS = 'MacOS'
 WINDOWS = 'Windows'
 
+# sections of a qif file in their platform's order, each one ends at the
+# tag starting the next one: (section, next tag, next section's name)
+# for macos, the transactions start at the first '!Account' tag, which is
+# also used for separating them
+SECTIONS = {
+    WINDOWS: (
+        ("categories", OPTION_AUTO_SWITCH, "account list"),
+        ("account_list", CLEAR_AUTO_SWITCH, "transactions"),
+    ),
+    MACOS: (
+        ("account_list", CLEAR_AUTO_SWITCH, "categories"),
+        ("categories", ACCOUNT_TAG, "transactions"),
+    ),
+}
+
+# two digits years above this one are in the 20th century (see convert_date)
+PIVOT_YEAR = datetime.now().year + 2 - 2000
+
+# size of the convert_date caches, qif files repeat the same dates a lot
+# (8192 days is over 22 years of daily transactions)
+DATE_CACHE_SIZE = 8192
+
 # ---------------------------------------------------------------------------
 #   Utilities
 # ---------------------------------------------------------------------------
@@ -87,10 +200,55 @@ def get_platform(qif_file):
     raise ValueError('Unsupported file type!')
 
 
+def detect_encoding(qif_file):
+    """
+    Guesses the encoding of a qif file, used when none is passed.
+
+    A file starting with a utf-8 BOM is utf-8-sig, one starting with a
+    utf-16 BOM (either byte order) is utf-16. Otherwise the file is
+    utf-8 if it all decodes as utf-8 and cp1252 if it doesn't. A file
+    with accents only near its end is still a valid cp1252 file, so the
+    whole file is checked and not only its beginning.
+    """
+
+    decoder = codecs.getincrementaldecoder(ENCODING_UTF8)()
+    with open(qif_file, mode='rb', buffering=READ_BUFFER_SIZE) as fp:
+        block = fp.read(READ_BLOCK_SIZE)
+        if block.startswith(codecs.BOM_UTF8):
+            return ENCODING_UTF8_SIG
+        if block.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+            return ENCODING_UTF16
+
+        try:
+            while block:
+                decoder.decode(block)
+                block = fp.read(READ_BLOCK_SIZE)
+            decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            return ENCODING_CP1252
+
+    return ENCODING_UTF8
+
+
 
 # date conversion
 # ---------------
 
+def format_date(year, month, day):
+    """
+    Returns YYYY-MM-DD from the year, month and day (str or int).
+
+    Skips strftime, but date() still checks the calendar (and the 4 digits
+    year) so invalid dates raise a ValueError.
+    """
+
+    year, month, day = int(year), int(month), int(day)
+    date(year, month, day)
+
+    return f'{year:04d}-{month:02d}-{day:02d}'
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
 def convert_date_windows(qif_date):
     """
     Convert a date with Quicken strange format to a YYYY-MM-DD.
@@ -102,29 +260,19 @@ def convert_date_windows(qif_date):
     here, 2 is the month, 1 is the day and 3 is the year
     """
 
-    # first split we'll get month and rest
-    month, rest = qif_date.split('/')
-    day, year = rest.split("'")
-
-    # remove whitespace
-    month = month.strip()
-    day = day.strip()
-    year = year.strip()
-
-    # pad with zeros
-    if len(month) < 2:
-        month = f'0{month}'
-    if len(day) < 2:
-        day = f'0{day}'
+    # both separators become spaces so one split() gives the three parts
+    # without their whitespace
+    month, day, year = qif_date.translate(WIN_DATE_SEPARATORS).split()
 
     if len(year) < 2:
         year = f'200{year}'
     elif len(year) < 3:
         year = f'20{year}'
 
-    return datetime(int(year), int(month), int(day)).strftime("%Y-%m-%d")
+    return format_date(year, month, day)
 
 
+@lru_cache(maxsize=DATE_CACHE_SIZE)
 def convert_date(qif_date):
     """
     Convert a date with format MM/DD/YY to YYYY-MM-DD.
@@ -136,224 +284,153 @@ def convert_date(qif_date):
         between 22 and 99 will be in 20th century (1922)
 
     Note: this is the format used by Quicken MacOS
+
+    Results are cached since a qif file has many transactions on the same day.
     """
 
     if "'" in qif_date:
         return convert_date_windows(qif_date)
 
-    month, day, year = qif_date.split('/')
-    pivot_year = datetime.now().year + 2 - 2000
-    if pivot_year < int(year) <= 99:
+    # most dates are MM/DD/YY, slice these instead of splitting
+    if len(qif_date) == 8 and qif_date[2] == '/' and qif_date[5] == '/':
+        month, day, year = qif_date[:2], qif_date[3:5], qif_date[6:]
+    else:
+        month, day, year = qif_date.split('/')
+
+    if PIVOT_YEAR < int(year) <= 99:
         year = '19' + year
     else:
         year = '20' + year
 
-    return datetime(int(year), int(month), int(day)).strftime("%Y-%m-%d")
-
-
-# ---------------------------------------------------------------------------
-#   Parsing helpers
-# ---------------------------------------------------------------------------
-
-# def init_account(use_defaults=USE_DEFAULTS_FOR_ACCOUNTS):
-#     """
-#     Creates and return an empty account dictionary.
-
-#     The parse functions uses this instead of simply
-#     calling account = {}
-#     This freezes keys order.
-#     """
-
-#     if not use_defaults:
-#         return {}
+    return format_date(year, month, day)
 
-#     return {
-#         "Name": "",
-#         "Description": "",
-#         "Type": "",
-#         "Transaction Count": 0,
-#         "Transactions": []
-#     }
 
+def refresh_pivot_year():
+    """
+    Recomputes PIVOT_YEAR from today's date and clears the convert_date
+    cache. PIVOT_YEAR is computed once at import, this is only needed by
+    processes still running when the year changes.
+    """
 
-# def init_transaction(use_defaults=USE_DEFAULTS_FOR_TRANSACTIONS):
-#     """
-#     Creates and return an empty transaction dictionary.
-
-#     The parse functions uses this instead of simply
-#     calling transaction = {}
-#     This freezes keys order.
-#     """
+    global PIVOT_YEAR
+    PIVOT_YEAR = datetime.now().year + 2 - 2000
+    convert_date.cache_clear()
 
-#     if not use_defaults:
-#         return {}
 
-#     return {
-#         "Date": "",
-#         "Payee": "",
-#         "Amount": "",
-#         "Category": "",
-#     }
+# ---------------------------------------------------------------------------
+#   Parsing helpers
+# ---------------------------------------------------------------------------
 
 def chunk_to_list(chunk):
-    """Converts a chunk to a list"""
-    return chunk.split(QIF_LINE_SEPARATOR)
-
-
-def qif2str(qif_file, encoding):
-    """Reads a qif file and returns a Python str"""
-
-    with open(qif_file, mode='r', encoding=encoding) as fp:
-        data = fp.read()
-
-    if len(data) == 0:
-        raise Qif2JsonException("Data is empty")
-    return data
-
-
-def qif2list(qif_file, encoding):
-    """Parse a qif file and returns a list of entries"""
-
-    qif_str = qif2str(qif_file, encoding=encoding)
-
-    qif_list = qif_str.split(QIF_CHUNK_SEPARATOR)
-
-    return qif_list
-
+    """
+    Converts a chunk to a list of its data lines.
 
+    Header lines (starting with '!') and empty lines are left out here,
+    so the parsers never see them and line[0] is always safe. Headers
+    only ever start a chunk, so they're cut off before splitting and the
+    lines don't have to be filtered one by one.
 
-def get_sections_ranges(qif_list, platform=WINDOWS):
+    Note: str.split is done in C and is faster than scanning the file
+    with a (multiline) regex, so we keep splitting chunks then lines.
     """
-    Passing a list of qif file entries, return a dictionary with
-    three keys: categories, account_list, transactions
-    where each value is a tupple (start, end)
+    while chunk[:1] == '!':
+        _, _, chunk = chunk.partition(QIF_LINE_SEPARATOR)
 
-    :param qif_list: list of an already parsed qif file
-    :return dictionary
+    lines = chunk.split(QIF_LINE_SEPARATOR)
+    if not all(lines):
+        lines = [line for line in lines if line]
+    return lines
 
-    return value example:
 
-    {
-        "categories": (0, 2245, ),
-        "account_list": (2246, 22254, ),
-        "transactions": (22255, 1231123)
-    }
+def qif2chunks(qif_file, encoding, block_size=READ_BLOCK_SIZE):
+    """
+    Reads a qif file by blocks and yields its entries one at a time.
 
-    Purpose:
-    Helps parsing categories, account list and transactions
+    Gives the same entries as fp.read().split(QIF_CHUNK_SEPARATOR) but only
+    the current block and the unfinished entry are kept in memory.
     """
 
-    result = {
-        "categories": None,
-        "account_list": None,
-        "transactions": None
-    }
-    first_category_index = None
-    first_account_index = None
-    first_transaction_index = None
-
-    # remove last element if its empty
-    last_index = len(qif_list) - 1
-    if qif_list[last_index] == '':
-        last_index -= 1
-
-    # assumes windows order is categories, account list, transactions
-    if platform == WINDOWS:
-        for index, entry in enumerate(qif_list):
-            if entry.startswith(CATEGORY_TAG_WIN):
-                first_category_index = index
-            elif entry.startswith(OPTION_AUTO_SWITCH):
-                first_account_index = index
-            elif entry.startswith(CLEAR_AUTO_SWITCH):
-                first_transaction_index = index
-            else:
+    separator_length = len(QIF_CHUNK_SEPARATOR)
+    # a separator can straddle two blocks, keep enough of the previous one
+    tail_length = separator_length - 1
+
+    # blocks of the unfinished entry, only joined once a separator shows up
+    # so long entries aren't copied and rescanned on every block
+    pending = []
+    tail = ''
+    with open(qif_file, mode='r', encoding=encoding, buffering=READ_BUFFER_SIZE) as fp:
+        while True:
+            block = fp.read(block_size)
+            if not block:
+                break
+
+            pending.append(block)
+            if QIF_CHUNK_SEPARATOR not in tail + block:
+                tail = (tail + block)[-tail_length:]
                 continue
 
-        result["categories"] = (0, first_account_index - 1, )
-        result["account_list"] = (first_account_index, first_transaction_index - 1, )
-        result["transactions"] = (first_transaction_index, last_index, )
-
-    # assumes macos order is account list, categories, transactions
-    else:  # MACOS
-        for index, entry in enumerate(qif_list):
-            if entry.startswith(OPTION_AUTO_SWITCH):
-                first_account_index = index
-            elif entry.startswith(CLEAR_AUTO_SWITCH):
-                first_category_index = index
-            # for macos, the first entry for transaction is '!Account'
-            # which is also used for separating transactions
-            elif entry.startswith(ACCOUNT_TAG):
-                first_transaction_index = index
-                break  # stop at the first !Account tag
-            else:
-                continue
+            buffer = ''.join(pending)
+            start = 0
+            end = buffer.find(QIF_CHUNK_SEPARATOR, max(0, len(buffer) - len(block) - tail_length))
+            while end != -1:
+                yield buffer[start:end]
+                start = end + separator_length
+                end = buffer.find(QIF_CHUNK_SEPARATOR, start)
 
-        result["account_list"] = (0, first_category_index - 1, )
-        result["categories"] = (first_category_index, first_transaction_index - 1, )
-        result["transactions"] = (first_transaction_index, last_index, )
+            rest = buffer[start:]
+            pending = [rest]
+            tail = rest[-tail_length:]
 
-    return result
+    yield ''.join(pending)
 
 
-def parse_transaction_account(account_chunk):
+def split_sections(chunks, platform=WINDOWS):
     """
-    Parse the account information part from a chunk's transaction.
+    Reads the categories and account list entries from the chunks iterator
+    (see qif2chunks) and returns them with an iterator over the transaction
+    entries, which are left unread.
 
+    :return tuple (categories list, account list, transactions iterator)
 
-    :param account_chunk: string separated by new line character
-
-    A account_chunk contains all informations about a Qif account.
+    Sections are expected in the order given by SECTIONS.
     """
 
-    lines = chunk_to_list(account_chunk)
-    account = {}
-    for line in lines:
-        prefix = line[0]
-        data = line[1:]
-
-        if prefix == '!': continue
-        elif prefix == 'N': account["name"] = data
-        elif prefix == 'B': account["balance"] = data
-        elif prefix == 'D': account["description"] = data
-        elif prefix == 'T': account["type"] = data
-        elif prefix == 'L': account["credit_limit"] = data
-        elif prefix == 'A': account["address"] = data
+    chunks = iter(chunks)
+    result = {}
+    entries = []
+    for name, next_tag, next_name in SECTIONS.get(platform, SECTIONS[MACOS]):
+        for entry in chunks:
+            if entry[:1] == '!' and entry.startswith(next_tag):
+                break
+            entries.append(entry)
         else:
-            raise ValueError(f'Unknown prefix: {prefix}')
-    return account
+            if not result and not any(entries):
+                raise Qif2JsonException("Data is empty")
+            raise Qif2JsonException(f'No {next_name} found ({next_tag})')
 
+        result[name] = entries
+        entries = [entry]  # the tag's entry starts the next section
 
-def parse_splits(chunk_lines):
-    """
-    Parse splits from a chunk_lines (as list) and return
-    a list of splits.
+    return result["categories"], result["account_list"], chain(entries, chunks)
 
-    :param chunk_lines: list
 
-    Note:
-    -----
-    Assume split infos have 3 lines where a line which starts
-    with 'S' begin split infos and the next 2 lines begin with '$'
-    and 'E' in that order.
+def parse_fields(chunk, fields, record, empty=None):
     """
+    Stores every line of a chunk in record, under the key fields maps
+    its prefix to, and returns record.
 
-    split = {}
-    splits = []
-
-    for index, line in enumerate(chunk_lines):
-        prefix = line[0]
-        data = line[1:]
+    :param fields: dict, prefix -> key, an unknown prefix is a ValueError
+    :param empty: value stored for lines without data
 
-        if prefix == 'S': split["category"] = data
-        elif prefix == 'E': split["memo"] = data
-        elif prefix == '$':
-            split["amount"] = data
-            splits.append(split)
-            split = {}
-        else:
-            continue
+    Shared by the parsers where every prefix is a plain field.
+    """
 
-    return splits
+    for line in chunk_to_list(chunk):
+        key = fields.get(line[0])
+        if key is None:
+            raise ValueError(f'Unknown prefix: {line[0]}, chunk: {chunk}')
+        record[key] = line[1:] or empty
+    return record
 
 
 
@@ -366,27 +443,21 @@ def parse_splits(chunk_lines):
 # ---------------------------------------------------------------------------
 
 def parse_category(cat_chunk):
-    category = {
-        "name": None,
-        "description": None,
-        "type": None,   # 'I' for income, 'E' for expense
-        "tax": None,    # a number if category is tax related,
-    }
+    category = CATEGORY_TEMPLATE.copy()
 
     lines = chunk_to_list(cat_chunk)
     for line in lines:
         prefix = line[0]
-        data = line[1:]
-        if not data: data = None
-        if prefix == '!': continue
 
         # not documented for categories and is
         # always empty in both my mac and windows
         # data files
-        elif prefix == 'T': continue
-        elif prefix == 'N': category["name"] = data
-        elif prefix == 'D': category["description"] = data
-        elif prefix == 'R': category["tax"] = data
+        if prefix == 'T': continue
+
+        data = line[1:] or None
+        key = CATEGORY_FIELDS.get(prefix)
+        if key is not None:
+            category[key] = data
 
         # special cases
         elif prefix == 'E':
@@ -415,7 +486,7 @@ def parse_categories(cat_list):
     python category object.
     """
 
-    return [parse_category(c) for c in cat_list]
+    return [parse_category(c) for c in cat_list if c and not c.isspace()]
 
 
 # ---------------------------------------------------------------------------
@@ -423,28 +494,7 @@ def parse_categories(cat_list):
 # ---------------------------------------------------------------------------
 
 def new_parse_account(acc_chunk):
-
-    lines = chunk_to_list(acc_chunk)
-    account = {
-        "name": None,
-        "description": None,
-        "type": None,
-    }
-    for line in lines:
-        prefix = line[0]
-        data = line[1:]
-        if not data: data = None
-
-        if prefix == '!': continue
-        elif prefix == 'N': account["name"] = data
-        elif prefix == 'B': account["balance"] = data
-        elif prefix == 'D': account["description"] = data
-        elif prefix == 'T': account["type"] = data
-        elif prefix == 'L': account["credit_limit"] = data
-        elif prefix == 'A': account["address"] = data
-        else:
-            raise ValueError(f'Unknown prefix: {prefix}')
-    return account
+    return parse_fields(acc_chunk, ACCOUNT_FIELDS, ACCOUNT_TEMPLATE.copy())
 
 
 def parse_account_list(account_list):
@@ -453,7 +503,7 @@ def parse_account_list(account_list):
     python account object.
     """
 
-    return [new_parse_account(a) for a in account_list]
+    return [new_parse_account(a) for a in account_list if a and not a.isspace()]
 
 
 # ---------------------------------------------------------------------------
@@ -469,32 +519,8 @@ def parse_transaction_account_info(chunk):
             (account name, account infos, )
     """
 
-    account_name = None
-    account_info = {}
-
-    lines = chunk_to_list(chunk)
-    for line in lines:
-        prefix = line[0]
-        data = line[1:]
-        if not data: data = None
-
-        if prefix == '!': continue
-        elif prefix == 'N':
-            account_name = data
-            account_info["name"] = account_name
-        elif prefix == 'T': account_info["type"] = data
-        elif prefix == 'D': account_info["description"] = data
-
-        # mac qmtf file specifics
-        elif prefix == 'B': account_info["balance"] = data
-        elif prefix == 'L': account_info["credit_limit"] = data
-        elif prefix == 'A': account_info["memo"] = data
-
-
-        else:
-            raise ValueError(f'Unknown prefix: {prefix}, chunk: {chunk}')
-
-    return account_name, account_info
+    account_info = parse_fields(chunk, TRANSACTION_ACCOUNT_FIELDS, {})
+    return account_info.get("name"), account_info
 
 
 def parse_account_transaction(transaction_chunk):
@@ -507,36 +533,56 @@ def parse_account_transaction(transaction_chunk):
     """
     lines = chunk_to_list(transaction_chunk)
     transaction = {}
+    address_lines = []
+    splits = None  # filled as the S/E/$ lines are read
+    split = {}
+
+    # locals are faster to look up than globals in the loop (and keep the
+    # loop free of global state, should it be compiled with Cython one day)
+    get_field = TRANSACTION_FIELDS.get
+    get_interned_field = INTERNED_TRANSACTION_FIELDS.get
+    split_fields = SPLIT_FIELDS
+    split_prefixes = SPLIT_PREFIXES
+    to_date = convert_date
+    intern = sys.intern
 
     for line in lines:
         prefix = line[0]
+
+        key = get_field(prefix)
+        if key is not None:
+            transaction[key] = line[1:]
+            continue
+
+        key = get_interned_field(prefix)
+        if key is not None:
+            transaction[key] = intern(line[1:])
+            continue
+
         data = line[1:]
 
-        if prefix == '!': continue
-        elif prefix == 'D': transaction["date"] = convert_date(data)
-        elif prefix == 'P': transaction["payee"] = data
-        elif prefix == 'M': transaction["memo"] = data
-        elif prefix == 'T': transaction["amount"] = data
-        elif prefix == 'U': transaction["amount2"] = data
-        elif prefix == 'C': transaction["reconciled"] = data
-        elif prefix == 'L': transaction["category"] = data
-        elif prefix == 'N': transaction["ref_number"] = data
-        elif prefix == 'F': transaction["reimbursable"] = data
-        elif prefix == 'Y': transaction["security_name"] = data
-        elif prefix == 'I': transaction["security_price"] = data
-        elif prefix == 'Q': transaction["share_qty"] = data
-        elif prefix == 'O': transaction["commission_cost"] = data
+        if prefix == 'D': transaction["date"] = to_date(data)
         elif prefix == 'A':
-            if not transaction.get("address"):
-                transaction["address"] = data
+            # joined after the loop, the key is set here to keep its position
+            if not address_lines:
+                transaction["address"] = None
+            address_lines.append(data)
+        elif prefix in split_prefixes:
+            if splits is None:
+                splits = transaction["splits"] = []
+            if prefix == '$':
+                split["amount"] = data
+                splits.append(split)
+                split = {}
             else:
-                transaction["address"] += (data + '\n')
-        elif prefix == '$' or prefix == 'S' or prefix == 'E':
-            transaction["splits"] = parse_splits(lines)
+                split[split_fields[prefix]] = data
         else:
             print(transaction_chunk)
             raise ValueError(f'Unknown prefix: {prefix}')
 
+    if address_lines:
+        transaction["address"] = QIF_LINE_SEPARATOR.join(address_lines)
+
     return transaction
 
 
@@ -557,59 +603,71 @@ def parse_transaction_list(list_):
     }
 
     """
-    result = []
-    account_name = None  # (for convenience, also in account infos)
-    account_infos = None  # each transaction list for a account has this
-    account_group = {
-        "account_name": None,
-        "account_infos": None,
+    return list(iter_transaction_list(list_))
+
+
+def new_account_group():
+    """Returns an empty account group (see parse_transaction_list)"""
+    return {
+        "account_name": None,  # (for convenience, also in account infos)
+        "account_infos": None,  # each transaction list for a account has this
         "account_transactions": []
     }
 
+
+def iter_transaction_list(list_):
+    """
+    Same as parse_transaction_list but yields each account's dictionary
+    as soon as all its transactions are parsed.
+    """
+    account_group = new_account_group()
+
     for t in list_:
-        if ACCOUNT_TAG in t:
+        if not t or t.isspace():
+            continue  # the file ends with a separator (and maybe blank lines)
+
+        # only header entries start with '!', this skips the substring
+        # search for transactions (windows has '!Clear:AutoSwitch' before
+        # the first '!Account' so startswith alone isn't enough)
+        if t[:1] == '!' and ACCOUNT_TAG in t:
+            # check if we're processing transactions for a new account
             if account_group["account_transactions"]:
-                result.append(account_group)
-                account_group = account_group = {
-                    "account_name": None,
-                    "account_infos": None,
-                    "account_transactions": []
-                }
+                yield account_group
+                account_group = new_account_group()
             account_name, account_infos = parse_transaction_account_info(t)
             account_group["account_name"] = account_name
             account_group["account_infos"] = account_infos
-            # check if we're processing transactions for a new account
 
         else:
             account_transaction = parse_account_transaction(t)
             account_group["account_transactions"].append(account_transaction)
     # save last transactions
-    result.append(account_group)
-    return result
+    yield account_group
+
+
+def parse_qif_file(qif_path, encoding=None, platform=WINDOWS):
+    data = stream_qif_file(qif_path, encoding=encoding, platform=platform)
+    data["transactions"] = list(data["transactions"])
+    return data
 
 
-def parse_qif_file(qif_path, encoding=ENCODING_CP1252, platform=WINDOWS):
+def stream_qif_file(qif_path, encoding=None, platform=WINDOWS):
+    """
+    Same as parse_qif_file except that "transactions" is a generator,
+    each account is parsed when the generator gets to it. Used by
+    convert_qif so the parsed transactions never are all in memory.
+
+    The encoding is guessed with detect_encoding when it's None.
+    """
     qif_path = Path(qif_path)
-    list_ = qif2list(qif_path, encoding=encoding)
-    all_sections = get_sections_ranges(list_, platform=platform)
+    if encoding is None:
+        encoding = detect_encoding(qif_path)
+    chunks = qif2chunks(qif_path, encoding=encoding)
+    cat_list, account_list, transaction_list = split_sections(chunks, platform=platform)
 
-    # categories
-    start = all_sections["categories"][0]
-    end = all_sections["categories"][1]
-    cat_list = list_[start:end + 1]
     categories = parse_categories(cat_list)
-
-    # account list
-    start = all_sections["account_list"][0]
-    end = all_sections["account_list"][1]
-    account_list = list_[start:end + 1]
     accounts = parse_account_list(account_list)
-
-    # transactions
-    start = all_sections["transactions"][0]
-    end = all_sections["transactions"][1]
-    transaction_list = list_[start:end + 1]
-    transactions = parse_transaction_list(transaction_list)
+    transactions = iter_transaction_list(transaction_list)
 
     return {
         "categories": categories,
@@ -618,23 +676,96 @@ def parse_qif_file(qif_path, encoding=ENCODING_CP1252, platform=WINDOWS):
     }
 
 
-def convert_qif(qif_path, output_path, encoding=ENCODING_CP1252):
+def convert_qif(qif_path, output_path, encoding=None):
     """
     Converts a qif formatted file using the passed encoding to json.
 
     :params qif_path: full path to qif file
     :params output: full path where the json file will end up
-    :params encoding: of the qif file (utf-8 or cp1252) default is cp1252
+    :params encoding: of the qif file (utf-8, utf-16 or cp1252), guessed if None
     """
 
     qif_path = Path(qif_path)
     output = Path(output_path)
-    filename, file_extension = os.path.splitext(qif_path)
     platform = get_platform(qif_path)
 
-    data = parse_qif_file(qif_path, encoding=encoding, platform=platform)
-    with open(output, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    data = stream_qif_file(qif_path, encoding=encoding, platform=platform)
+    dump_json(data, output)
+
+
+def to_json(obj):
+    """
+    Returns obj as indented json, encoded in utf-8.
+
+    Uses orjson when it is installed, otherwise the json module. Both
+    give the same output.
+    """
+
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+
+
+def iter_json(data):
+    """
+    Yields the indented json of the data dictionary piece by piece.
+
+    Iterator values are encoded one item at a time as the iterator gives
+    them. The joined pieces are the same as to_json(data) with these
+    iterators as lists.
+    """
+
+    # json escapes new lines in strings, so every new line is indentation
+    def indent(text, level):
+        return text.replace(b'\n', b'\n' + b'  ' * level)
+
+    yield b'{'
+    for index, (key, value) in enumerate(data.items()):
+        yield b',\n  ' if index else b'\n  '
+        yield to_json(key) + b': '
+
+        if not isinstance(value, Iterator):
+            yield indent(to_json(value), 1)
+            continue
+
+        empty = True
+        for item in value:
+            yield b'[\n    ' if empty else b',\n    '
+            yield indent(to_json(item), 2)
+            empty = False
+        yield b'[]' if empty else b'\n  ]'
+
+    yield b'\n}' if data else b'}'
+
+
+def dump_json(data, output):
+    """
+    Writes the data dictionary to output as an indented utf-8 json file.
+
+    Iterator values are written as they're consumed (see iter_json), so the
+    json goes to a temporary file which replaces output once it's complete.
+    A parsing error leaves any previous output untouched.
+
+    An existing output keeps its permissions and, when output is a symlink,
+    the file it points to is the one replaced. Output being replaced, it
+    won't be shared anymore by other hard links.
+    """
+
+    output = os.path.realpath(output)
+    directory, name = os.path.split(output)
+    # open() gives the temporary file the default (umask) permissions
+    temp_path = os.path.join(directory, f'.{name}.{os.getpid()}.tmp')
+    try:
+        with open(temp_path, 'wb') as f:
+            for piece in iter_json(data):
+                f.write(piece)
+        if os.path.exists(output):
+            shutil.copymode(output, temp_path)
+        os.replace(temp_path, output)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
 
 def convert_qif_test():
@@ -645,17 +776,16 @@ def convert_qif_test():
 
 
 def run_convert_qif():
-    default_encoding = ENCODING_CP1252
-
     parser = argparse.ArgumentParser(description='Enter the path to the qif file.')
     parser.add_argument('path', type=str, help="full path to a qif file")
     parser.add_argument('output', type=str, help=f"full path of json output file")
-    parser.add_argument('--encoding', type=str, help=f"encoding of the qif file, either utf-8 or cp1252 (default to {default_encoding})", default=default_encoding)
+    parser.add_argument('--encoding', type=str, default=None,
+                        help="encoding of the qif file, utf-8, utf-16 or cp1252 (guessed from the file by default)")
 
     args = parser.parse_args()
     qif_path = Path(args.path)
     output = Path(args.output)
-    encoding = args.encoding or default_encoding
+    encoding = args.encoding or detect_encoding(qif_path)
 
     print(f"Converting qif file: {qif_path} encoding: {encoding}")
     convert_qif(qif_path, output, encoding=encoding)
@@ -1,11 +1,26 @@
+import json
 from pathlib import Path
 
+import pytest
+
 from qif2json import __version__
 
+import qif2json.qif2json as qif2json_module
 from qif2json.qif2json import (
     WINDOWS, MACOS,
+    QIF_CHUNK_SEPARATOR,
+    Qif2JsonException,
     get_platform,
+    detect_encoding,
     convert_date,
+    qif2chunks,
+    dump_json,
+    iter_json,
+    chunk_to_list,
+    split_sections,
+    parse_account_transaction,
+    parse_qif_file,
+    refresh_pivot_year,
 )
 
 
@@ -62,10 +77,99 @@ def test_get_platform():
     assert result == WINDOWS
 
 
+def test_detect_encoding(tmpdir):
+    qif_file = tmpdir.join('test.qif')
+    # accents far from the start must still be found
+    data = "!Type:Cat\nNFood\n^\n" * 10000 + "NCafé\n^\n"
+
+    qif_file.write_binary(data.encode('utf-8'))
+    assert detect_encoding(str(qif_file)) == 'utf-8'
+
+    qif_file.write_binary(data.encode('cp1252'))
+    assert detect_encoding(str(qif_file)) == 'cp1252'
+
+    qif_file.write_binary(data.encode('utf-8-sig'))
+    assert detect_encoding(str(qif_file)) == 'utf-8-sig'
+
+    for encoding in ('utf-16', 'utf-16-le', 'utf-16-be'):
+        bom = '\ufeff' if encoding != 'utf-16' else ''
+        qif_file.write_binary((bom + data).encode(encoding))
+        assert detect_encoding(str(qif_file)) == 'utf-16'
+        chunks = list(qif2chunks(str(qif_file), 'utf-16'))
+        assert chunks == data.split(QIF_CHUNK_SEPARATOR)
+
+
 # -------------------------------------------------------------------------
 #   Parsing
 # -------------------------------------------------------------------------
 
+# ---------- reading -----------------
+
+def test_qif2chunks_matches_split(tmpdir):
+    # the long memo spans many blocks before its separator shows up
+    for data in ("!Type:Cat\nNFood\nE\n^\nNSalary\nI\n^\n!Option:AutoSwitch\n^\n",
+                 "D11/07/13\nM" + "memo " * 100 + "\n^\n^\nD11/08/13\n^"):
+        qif_file = tmpdir.join('test.qif')
+        qif_file.write(data)
+
+        expected = data.split(QIF_CHUNK_SEPARATOR)
+        # small blocks so separators end up split between two reads
+        for block_size in (1, 2, 3, 5, 1024):
+            result = list(qif2chunks(str(qif_file), 'utf-8', block_size=block_size))
+            assert result == expected
+
+
+def test_dump_json_without_orjson(tmpdir, monkeypatch):
+    data = {"payee": "Café", "splits": [{"amount": "-1.00"}], "tax": None}
+    expected = json.dumps(data, ensure_ascii=False, indent=2)
+
+    output = tmpdir.join('out.json')
+    monkeypatch.setattr(qif2json_module, 'orjson', None)
+    dump_json(data, str(output))
+    assert output.read_text('utf-8') == expected
+
+
+def test_dump_json_keeps_output_on_error(tmpdir):
+    output = tmpdir.join('out.json')
+    output.write('previous')
+
+    def transactions():
+        yield {"payee": "Hydro"}
+        raise Qif2JsonException("bad transaction")
+
+    with pytest.raises(Qif2JsonException):
+        dump_json({"transactions": transactions()}, str(output))
+    assert output.read() == 'previous'
+    assert tmpdir.listdir() == [output]
+
+
+def test_dump_json_keeps_mode_and_symlink(tmpdir):
+    target = tmpdir.join('target.json')
+    target.write('previous')
+    target.chmod(0o640)
+    link = tmpdir.join('link.json')
+    link.mksymlinkto(target)
+
+    dump_json({"categories": []}, str(link))
+    assert link.islink()
+    assert json.loads(target.read()) == {"categories": []}
+    assert target.stat().mode & 0o777 == 0o640
+
+
+def test_iter_json_streams_iterators():
+    groups = [{"account_name": "Visa", "account_transactions": [{"memo": "a\nb"}]}, {}]
+    data = {"categories": [], "accounts": [{"name": None}], "transactions": groups}
+    expected = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+
+    streamed = dict(data, transactions=iter(groups))
+    assert b''.join(iter_json(streamed)) == expected
+
+    empty = dict(data, transactions=[])
+    expected = json.dumps(empty, ensure_ascii=False, indent=2).encode('utf-8')
+    streamed = dict(data, transactions=iter([]))
+    assert b''.join(iter_json(streamed)) == expected
+
+
 # ---------- parse dates -----------------
 
 def test_convert_date_standard_separators():
@@ -80,3 +184,107 @@ def test_convert_date_weird_separators():
     result = convert_date(test_date)
     expected = "2001-03-02"
     assert result == expected
+
+
+def test_convert_date_invalid():
+    with pytest.raises(ValueError):
+        convert_date("13/07/13")
+
+    with pytest.raises(ValueError):
+        convert_date("02/30/13")
+
+    with pytest.raises(ValueError):
+        convert_date("4/31'5")
+
+    with pytest.raises(ValueError):
+        convert_date("1/7/2013")
+
+
+def test_convert_date_is_cached():
+    convert_date.cache_clear()
+    convert_date("11/07/13")
+    convert_date("11/07/13")
+    info = convert_date.cache_info()
+    assert info.hits == 1
+    assert info.misses == 1
+
+
+def test_refresh_pivot_year_clears_cache():
+    convert_date("11/07/13")
+    refresh_pivot_year()
+    assert convert_date.cache_info().currsize == 0
+
+
+# ---------- sections -----------------
+
+def test_split_sections_windows():
+    qif_list = ["!Type:Cat\nNFood", "!Option:AutoSwitch\n!Account\nNVisa",
+                "!Clear:AutoSwitch\n!Account\nNVisa", "D11/07/13", ""]
+    categories, accounts, transactions = split_sections(iter(qif_list), platform=WINDOWS)
+    assert categories == qif_list[0:1]
+    assert accounts == qif_list[1:2]
+    assert list(transactions) == qif_list[2:]
+
+
+def test_split_sections_macos():
+    qif_list = ["!Option:AutoSwitch\n!Account\nNVisa", "NCash",
+                "!Clear:AutoSwitch\n!TYPE:Cat\nNFood",
+                "!Account\nNVisa", "!Type:CCard\nD11/07/13", ""]
+    categories, accounts, transactions = split_sections(iter(qif_list), platform=MACOS)
+    assert accounts == qif_list[0:2]
+    assert categories == qif_list[2:3]
+    assert list(transactions) == qif_list[3:]
+
+
+def test_split_sections_errors():
+    with pytest.raises(Qif2JsonException, match="empty"):
+        split_sections(iter([""]), platform=WINDOWS)
+
+    with pytest.raises(Qif2JsonException, match="transactions"):
+        split_sections(iter(["NFood", "!Option:AutoSwitch\nNVisa"]), platform=WINDOWS)
+
+    with pytest.raises(Qif2JsonException, match="categories"):
+        split_sections(iter(["!Option:AutoSwitch\nNVisa", ""]), platform=MACOS)
+
+
+# ---------- parse transactions -----------------
+
+def test_chunk_to_list_skips_headers_and_empty_lines():
+    chunk = "!Clear:AutoSwitch\n!Account\nNVisa\n\nTCCard\n"
+    assert chunk_to_list(chunk) == ["NVisa", "TCCard"]
+    assert chunk_to_list("") == []
+
+
+def test_parse_account_transaction_address():
+    chunk = "D11/07/13\nT-10.00\nA1 rue X\nAMontréal\nAQC\nPHydro"
+    result = parse_account_transaction(chunk)
+    assert result == {
+        "date": "2013-11-07",
+        "amount": "-10.00",
+        "address": "1 rue X\nMontréal\nQC",
+        "payee": "Hydro",
+    }
+    assert list(result) == ["date", "amount", "address", "payee"]
+
+
+def test_parse_account_transaction_splits():
+    chunk = "D11/07/13\nT-3.00\nLFood\nSFood\nEgroc\n$-1.00\nSAuto\nE\n$-2.00"
+    result = parse_account_transaction(chunk)
+    assert result["splits"] == [
+        {"category": "Food", "memo": "groc", "amount": "-1.00"},
+        {"category": "Auto", "memo": "", "amount": "-2.00"},
+    ]
+
+
+def test_parse_qif_file_skips_blank_entries(tmpdir):
+    data = ("!Type:Cat\nNFood\nE\n^\n\n^\n"
+            "!Option:AutoSwitch\n!Account\nNVisa\nTCCard\n^\n"
+            "!Clear:AutoSwitch\n!Account\nNVisa\nTCCard\n^\n"
+            "!Type:CCard\nD11/07/13\nT-10.00\n^\n\n")
+    qif_file = tmpdir.join('test.qif')
+    qif_file.write(data)
+
+    result = parse_qif_file(str(qif_file), platform=WINDOWS)
+    assert [c["name"] for c in result["categories"]] == ["Food"]
+    [group] = result["transactions"]
+    assert group["account_transactions"] == [{"date": "2013-11-07", "amount": "-10.00"}]